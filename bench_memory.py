@@ -0,0 +1,50 @@
+# Measures how many bytes a creature (with its brain and connections) costs
+# usage: python bench_memory.py [max population]
+# Exits with 1 when the largest population measured misses the target, so a change that makes creatures bigger fails.
+import sys
+import time
+import tracemalloc
+
+from brain import EvaluationPlan
+from creature import Creature
+
+POPULATION_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+# This script run on the baseline commit, where Creature, Brain and Connection had a __dict__ per object,
+# lists of weights and color tuples: 1104.7 bytes per creature at 10k and 1104.0 at 100k creatures.
+# Measure it again with a checkout of that commit when the script changes.
+BASELINE_BYTES_PER_CREATURE = 1104
+TARGET_BYTES_PER_CREATURE = BASELINE_BYTES_PER_CREATURE // 2
+
+
+def bytes_per_creature(population: int) -> float:
+    # Every population pays for its own shared plans, otherwise the first one would pay for all of them
+    EvaluationPlan.get.cache_clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    creatures = [Creature((index % 1000, index // 1000), [], (index % 256, 0, 0), 10) for index in range(population)]
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    duration = time.perf_counter() - start
+    print(f"{population:>9} creatures: {used / population:8.1f} bytes per creature ({duration:0.2f}s)")
+    del creatures
+    return used / population
+
+
+def main() -> int:
+    max_population = int(sys.argv[1]) if len(sys.argv) > 1 else POPULATION_SIZES[-1]
+    results = [bytes_per_creature(population) for population in POPULATION_SIZES if population <= max_population]
+    if not results:
+        return 0
+    # Small populations also pay for things that are shared by every creature, like the plans
+    current = results[-1]
+    print(f"Baseline : {BASELINE_BYTES_PER_CREATURE} bytes per creature")
+    print(f"Target   : {TARGET_BYTES_PER_CREATURE} bytes per creature")
+    print(f"Current  : {current:0.1f} bytes per creature ({1 - current / BASELINE_BYTES_PER_CREATURE:0.1%} reduction)")
+    if current > TARGET_BYTES_PER_CREATURE:
+        print(f"Target missed by {current - TARGET_BYTES_PER_CREATURE:0.1f} bytes per creature")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
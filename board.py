@@ -1,15 +1,115 @@
+import functools
 import random
 import time
+from typing import Union
 
 import numpy as np
 
+import brain
+import creature as creature_module
+from brain import Brain, Rotation, SensoryNeuronType
 from creature import Creature
+from lineage import LineageStore
+from monitor import SharedStatePublisher
+from population import PopulationBrains
 
 random = random.Random()
 
 random.seed(1)
 
 
+def seed_random(seed: int):
+    # Every module has its own random instance, reseed all of them so a run can be reproduced
+    random.seed(seed)
+    creature_module.random.seed(seed)
+    brain.random.seed(seed)
+    brain.move_random.seed(seed)
+    brain.np_random = np.random.default_rng(seed)
+
+
+def get_random_state() -> tuple:
+    # Everything seed_random sets, so two boards can be stepped in turns without sharing random numbers
+    return (random.getstate(), creature_module.random.getstate(), brain.random.getstate(),
+            brain.move_random.getstate(), brain.np_random.bit_generator.state)
+
+
+def set_random_state(state: tuple):
+    random.setstate(state[0])
+    creature_module.random.setstate(state[1])
+    brain.random.setstate(state[2])
+    brain.move_random.setstate(state[3])
+    brain.np_random.bit_generator.state = state[4]
+
+
+class SensorTables:
+    """
+    Lookup tables for the sensors that only depend on the position and rotation of a creature.
+
+    Lx  = x / (width - 1), 0 on the left border and 1 on the right border
+    Ly  = y / (height - 1), 0 on the top border and 1 on the bottom border
+    BDx = distance to the closest left/right border / ((width - 1) / 2), 0 on a border and 1 in the middle
+    BDy = distance to the closest top/bottom border / ((height - 1) / 2), 0 on a border and 1 in the middle
+    Bfd = distance to the border the creature is facing / (width - 1) or (height - 1)
+
+    Every sensor only depends on one coordinate, so the tables are one row of values per coordinate.
+    Bfd is split in a table indexed by [rotation, x] and one by [rotation, y], where the rows for the other axis
+    are zero, so it can be looked up as the sum of both without branching on the rotation.
+    Lookups work with plain ints as well as numpy arrays of positions for the whole population.
+    """
+    location_x: np.ndarray
+    location_y: np.ndarray
+    border_x: np.ndarray
+    border_y: np.ndarray
+    border_forward_x: np.ndarray
+    border_forward_y: np.ndarray
+
+    def __init__(self, board_width: int, board_height: int):
+        # A board that is one tile wide would divide by zero
+        last_x = max(board_width - 1, 1)
+        last_y = max(board_height - 1, 1)
+        xs = np.arange(board_width, dtype=np.float64)
+        ys = np.arange(board_height, dtype=np.float64)
+        to_left = xs
+        to_right = (board_width - 1) - xs
+        to_top = ys
+        to_bottom = (board_height - 1) - ys
+
+        self.location_x = xs / last_x
+        self.location_y = ys / last_y
+        self.border_x = np.minimum(to_left, to_right) / (last_x / 2)
+        self.border_y = np.minimum(to_top, to_bottom) / (last_y / 2)
+
+        self.border_forward_x = np.zeros((4, board_width))
+        self.border_forward_y = np.zeros((4, board_height))
+        self.border_forward_x[Rotation.Left.value] = to_left / last_x
+        self.border_forward_x[Rotation.Right.value] = to_right / last_x
+        self.border_forward_y[Rotation.Up.value] = to_top / last_y
+        self.border_forward_y[Rotation.Down.value] = to_bottom / last_y
+
+        for table in (self.location_x, self.location_y, self.border_x, self.border_y, self.border_forward_x,
+                      self.border_forward_y):
+            table.setflags(write=False)  # Boards with the same size share these tables
+
+    def lookup(self, sensor_type: int, x: Union[int, np.ndarray], y: Union[int, np.ndarray],
+               rotation: Union[int, np.ndarray]) -> Union[float, np.ndarray]:
+        if sensor_type == SensoryNeuronType.Lx.value:
+            return self.location_x[x]
+        elif sensor_type == SensoryNeuronType.Ly.value:
+            return self.location_y[y]
+        elif sensor_type == SensoryNeuronType.BDx.value:
+            return self.border_x[x]
+        elif sensor_type == SensoryNeuronType.BDy.value:
+            return self.border_y[y]
+        elif sensor_type == SensoryNeuronType.Bfd.value:
+            return self.border_forward_x[rotation, x] + self.border_forward_y[rotation, y]
+        raise Exception(f"Sensor type {sensor_type} is not a positional sensor")
+
+
+@functools.lru_cache(maxsize=None)
+def get_sensor_tables(board_width: int, board_height: int) -> SensorTables:
+    return SensorTables(board_width, board_height)
+
+
 class Board:
     creatures: list[Creature]
     board_width: int
@@ -18,19 +118,42 @@ class Board:
     creature_count: int
     generation: int
     step: int
+    verbose: bool
+    skip_dormant: bool  # Skip the parts of brains that can never do anything, see Brain.compile_plan
+    batched: bool  # Evaluate all brains together with PopulationBrains, this always skips dormant connections
+    population_brains: Union[PopulationBrains, None]  # Made again when the creatures change
+    time_invariant: Union[bool, None]  # Every brain is time invariant, worked out again when the creatures change
+    moved_count: int  # How many creatures moved during the last tick
+    survival_rate: float  # get_survival_rate right before the last selection
+    timings: tuple[float, float, float, float]  # Of the last tick, see monitor.TimingNames
+    publisher: Union[SharedStatePublisher, None]
+    sensor_tables: SensorTables
 
-    logs: list[Creature]
+    logs: LineageStore
 
-    def __init__(self, board_size: (int, int), steps_per_generation: int, creature_count: int, mut_fac: float):
-        print("Main init")
+    def __init__(self, board_size: (int, int), steps_per_generation: int, creature_count: int, mut_fac: float,
+                 verbose: bool = True, skip_dormant: bool = True, batched: bool = True, log_capacity: int = 100_000,
+                 log_path: Union[str, None] = None, shared_state: Union[str, None] = None):
+        self.verbose = verbose
+        self.skip_dormant = skip_dormant
+        self.batched = batched
+        self.moved_count = 0
+        self.survival_rate = 0.0
+        self.timings = (0.0, 0.0, 0.0, 0.0)
+        if self.verbose:
+            print("Main init")
         self.board_width = board_size[0]
         self.board_height = board_size[1]
+        self.sensor_tables = get_sensor_tables(self.board_width, self.board_height)
         self.steps_per_generation = steps_per_generation
         self.creature_count = creature_count
         if self.creature_count % 2 != 0:
             self.creature_count -= 1
-        self.init_creatures(mut_fac)
         self.generation = 0
+        self.logs = LineageStore(log_capacity, log_path)
+        self.init_creatures(mut_fac)
+        # Other processes can watch the board through this shared memory, see monitor.py
+        self.publisher = SharedStatePublisher(shared_state, self.creature_count) if shared_state else None
         self.step = 0
 
     def get_all_free_spots(self):
@@ -45,15 +168,16 @@ class Board:
         return available
 
     def get_free_spot_matrix(self) -> np.ndarray:
-        matrix = np.empty((self.board_width, self.board_height), np.bool)
+        matrix = np.empty((self.board_width, self.board_height), bool)
         matrix.fill(True)
         for creature in self.creatures:
             pos = creature.get_pos()
             # TODO: off by one error waiting to happen
-            matrix.itemset((pos[0], pos[1]), False)
+            matrix[pos[0], pos[1]] = False
         return matrix
 
     def init_creatures(self, mut_fac: float):
+        self.creatures_changed()
         self.creatures = []
         free_spots = self.get_all_free_spots()
         random.shuffle(free_spots)
@@ -63,6 +187,21 @@ class Board:
                                     (random.randrange(0, 255), random.randrange(0, 255), random.randrange(0, 255)),
                                     mut_fac)
             self.creatures.append(new_creature)
+        self.log_births(self.creatures, [-1] * len(self.creatures))
+
+    def log_births(self, creatures: list[Creature], parents: list[int]):
+        ids = self.logs.record_births(parents, self.generation, [creature.get_genome_hash() for creature in creatures])
+        for creature, lineage_id in zip(creatures, ids):
+            creature.lineage_id = lineage_id
+
+    def creatures_changed(self):
+        self.population_brains = None
+        self.time_invariant = None
+
+    def get_population_brains(self) -> PopulationBrains:
+        if self.population_brains is None:
+            self.population_brains = PopulationBrains(self.creatures)
+        return self.population_brains
 
     def get_creatures(self):
         return self.creatures
@@ -77,39 +216,85 @@ class Board:
         start_tick = time.perf_counter()
         self.step += 1
 
-        def create_arg(entity: Creature) -> tuple[Creature, "Board"]:
-            return entity, self
-
-        args: list[tuple[Creature, "Board"]] = list(map(create_arg, self.creatures))
+        before_free_tiles = time.perf_counter()
+        # free_tiles = self.get_all_free_spots()
+        free_tiles_matrix = self.get_free_spot_matrix()
+        done_free_tiles = time.perf_counter()
 
         before_pool = time.perf_counter()
-        result = map(Creature.tick, args)  # pool.map(Creature.tick, args)
+        # Every creature thinks before anything moves, so they all sense the same board
+        result: list[tuple[Creature, Union[None, tuple[int, int]]]]
+        if self.batched:
+            self.get_population_brains().think(self, ~free_tiles_matrix)
+            result = [(creature, creature.get_queued_pos(self)) for creature in self.creatures]
+        else:
+            def create_arg(entity: Creature) -> tuple[Creature, "Board"]:
+                return entity, self
+
+            args: list[tuple[Creature, "Board"]] = list(map(create_arg, self.creatures))
+            result = list(map(Creature.tick, args))  # pool.map(Creature.tick, args)
         done_pool = time.perf_counter()
 
-        before_free_tiles = time.perf_counter()
-        # free_tiles = self.get_all_free_spots()
-        free_tiles_matrix = self.get_free_spot_matrix()
-        self.creatures = []
-        starting_for_loop = time.perf_counter()
+        self.moved_count = 0
         for creature, new_pos in result:
-            self.creatures.append(creature)
             if new_pos is None:
                 continue
             old_pos = creature.get_pos()
             if free_tiles_matrix.item((new_pos[0], new_pos[1])):
                 creature.set_pos(new_pos)
-                free_tiles_matrix.itemset((old_pos[0], old_pos[1]), True)
-                free_tiles_matrix.itemset((new_pos[0], new_pos[1]), False)
+                free_tiles_matrix[old_pos[0], old_pos[1]] = True
+                free_tiles_matrix[new_pos[0], new_pos[1]] = False
+                self.moved_count += 1
 
         moved_creatures = time.perf_counter()
+        self.timings = (moved_creatures - start_tick, done_pool - before_pool, done_free_tiles - before_free_tiles,
+                        moved_creatures - done_pool)
+        if self.publisher is not None:
+            self.publisher.publish(self)
+        if not self.verbose:
+            return
         print(f"Tick duration : {moved_creatures - start_tick :0.4f}s")
-        print(f"Pool          : {done_pool - beIfore_pool :0.4f}s")
-        print(f"Free tiles    : {starting_for_loop - before_free_tiles  :0.4f}s")
+        print(f"Pool          : {done_pool - before_pool :0.4f}s")
+        print(f"Free tiles    : {done_free_tiles - before_free_tiles  :0.4f}s")
         print(f"Moving        : {moved_creatures - done_pool :0.4f}s")
         print("")
 
+    def is_static(self) -> bool:
+        # Nothing moved during the last tick and every brain only reads sensors that don't change when nothing moves,
+        # so every tick until the end of the generation will do exactly the same as the last one
+        if self.moved_count > 0:
+            return False
+        if self.time_invariant is None:
+            self.time_invariant = all(creature.brain.plan.time_invariant for creature in self.creatures)
+        return self.time_invariant
+
+    def skip_ticks(self, count: int):
+        # Only use this when the board is static. The random sensor is still read by brains that can't move,
+        # those numbers are drawn so the next generations stay the same as when every tick was run
+        random_reads = sum(creature.brain.plan.random_reads for creature in self.creatures)
+        brain.Brain.skip_random_reads(random_reads * count)
+        self.step += count
+
+    def run_generation(self):
+        # Runs every tick of a generation and the selection at the end, the ticks after the board became static
+        # are skipped because they can't change the outcome
+        for step in range(self.steps_per_generation):
+            self.tick()
+            if self.is_static():
+                self.skip_ticks(self.steps_per_generation - step - 1)
+                break
+        self.tick_round()
+
+    def get_survival_rate(self) -> float:
+        # Fraction of the creatures that is in the left half of the board, which is the half that survives
+        if not self.creatures:
+            return 0.0
+        return sum(creature.x < self.board_width / 2 for creature in self.creatures) / len(self.creatures)
+
     def tick_round(self):
+        self.survival_rate = self.get_survival_rate()
         self.generation += 1
+        self.creatures_changed()
         # Kill half of the creatures from left to right on the screen
         sorted_creatures = sorted(self.creatures, key=lambda sorting_creature: sorting_creature.get_pos()[0],
                                   reverse=True)
@@ -125,16 +310,39 @@ class Board:
         # screenn.display(self)
         # time.sleep(5)
         self.creatures = []
-        for _ in range(round(self.creature_count / 2)):
-            sorted_creatures.pop(0)
+        killed = [sorted_creatures.pop(0) for _ in range(round(self.creature_count / 2))]
+        self.logs.record_deaths([creature.lineage_id for creature in killed], self.generation - 1)
         free_spots = self.get_all_free_spots()
         random.shuffle(free_spots)
-        for creature in sorted_creatures:
-            new_creature = creature.reproduce()
+        # The offspring are mutated together, that is a lot faster than mutating them one by one
+        offspring = [creature.reproduce(False) for creature in sorted_creatures]
+        Brain.mutate_brains([new_creature.brain for new_creature in offspring])
+        self.log_births(offspring, [creature.lineage_id for creature in sorted_creatures])
+        for creature, new_creature in zip(sorted_creatures, offspring):
             new_creature.set_pos(free_spots.pop())
             creature.set_pos(free_spots.pop())
             self.creatures.append(creature)
             self.creatures.append(new_creature)
+        if self.publisher is not None:
+            self.publisher.publish(self)
+
+    def sample_genomes(self, count: int) -> list[bytes]:
+        return [creature.get_genome() for creature in random.sample(self.creatures, count)]
+
+    def replace_creatures(self, genomes: list[bytes]):
+        # Immigrants take the place of random creatures, so the population size stays the same
+        self.creatures_changed()
+        indexes = random.sample(range(len(self.creatures)), len(genomes))
+        self.logs.record_deaths([self.creatures[index].lineage_id for index in indexes], self.generation)
+        for index, genome in zip(indexes, genomes):
+            self.creatures[index] = Creature.from_genome(self.creatures[index].get_pos(), genome)
+        # Immigrants don't have a parent on this board
+        self.log_births([self.creatures[index] for index in indexes], [-1] * len(indexes))
+
+    def close(self):
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
 
     def get_gen(self):
         return self.generation
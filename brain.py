@@ -1,12 +1,21 @@
 import enum
+import functools
+import math
 import random
-from typing import Union, TYPE_CHECKING
+from array import array
+from typing import Sequence, Union, TYPE_CHECKING
 
 import numpy as np
 
+# Mrn has its own random numbers, every sensor is read before any action is performed
+# so this keeps the random sensor the same no matter in which order creatures sense and act
+move_random = random.Random()
 random = random.Random()
 
 random.seed(1)
+move_random.seed(1)
+# Used for the batched mutations, where drawing one number at a time would be too slow
+np_random = np.random.default_rng(1)
 
 if TYPE_CHECKING:
     from main import Board
@@ -46,6 +55,11 @@ Mrv = move reverse
 MLR = move left/right (+/-)
 MX = move along the x axis (+/-)
 MY = move along the y axis (+/-) 
+
+Hidden neurons:
+Connections can also read from and write to one of the hidden neurons. A hidden neuron is the tanh of the sum
+of the connections that write to it. Connections that are part of a loop read the value from the previous tick,
+so hidden neurons can remember things.
 """
 
 
@@ -74,19 +88,45 @@ class ActionNeuronType(enum.Enum):
     MY = 18
 
 
-SensoryNeuronTypes = [item.value for item in SensoryNeuronType]
-ActionNeuronTypes = [item.value for item in ActionNeuronType]
+# These are shared by every brain, so they are tuples to make sure nobody changes them
+SensoryNeuronTypes = tuple(item.value for item in SensoryNeuronType)
+ActionNeuronTypes = tuple(item.value for item in ActionNeuronType)
+# The rotation of a creature never changes, so these sensors always return the same value for a creature
+ConstantSensorTypes = (
+    SensoryNeuronType.LMy.value,
+    SensoryNeuronType.LMx.value,
+)
+# Connection inputs past the sensory neurons and outputs past the action neurons are hidden neurons
+HiddenNeuronCount = 3
+# Sensors that can change while no creature moves
+TimeDependentSensorTypes = (
+    SensoryNeuronType.Age.value,
+    SensoryNeuronType.Rnd.value,
+    SensoryNeuronType.Osc.value,
+)
+# Sensors that are looked up in the sensor tables of the board, see board.SensorTables
+PositionalSensorTypes = (
+    SensoryNeuronType.Lx.value,
+    SensoryNeuronType.Ly.value,
+    SensoryNeuronType.BDx.value,
+    SensoryNeuronType.BDy.value,
+    SensoryNeuronType.Bfd.value,
+)
 
 
 class Connection:
+    # There can be millions of connections, slots, bytes and arrays keep them small.
+    # The inputs never change after a connection is made, bytes are a lot smaller than an array of the same values
+    __slots__ = ("inputs", "output", "weights", "bias")
+
     @staticmethod
     def create_connection(inputs: list[int], weights: list[float], bias: float, output: int) -> "Connection":
         if len(inputs) != len(weights):
             raise Exception("Connection inputs and weights not the same length")
         connection = Connection()
-        connection.inputs = inputs
+        connection.inputs = bytes(inputs)
         connection.output = output
-        connection.weights = weights
+        connection.weights = array("d", weights)
         connection.bias = bias
 
         return connection
@@ -134,23 +174,82 @@ class Connection:
         )
         return result
 
-    inputs: list[int]  # Connections use the index of a neuron in the neurons list
+    @staticmethod
+    def get_certainty_range(connection: "Connection", input_ranges: list[tuple[float, float]]) -> tuple[float, float]:
+        # The lowest and highest value the connection can have before the tanh, tanh doesn't change the order
+        lowest = highest = 0.0
+        for weight, (input_lowest, input_highest) in zip(connection.weights, input_ranges):
+            lowest += min(weight * input_lowest, weight * input_highest)
+            highest += max(weight * input_lowest, weight * input_highest)
+        count = len(connection.weights)
+        return lowest / count + connection.bias, highest / count + connection.bias
+
+    inputs: bytes  # Connections use the index of a neuron in the neurons list, or a hidden neuron after those
     output: int
-    weights: list[float]
+    weights: array
     bias: float
 
 
-# todo: Create neurons that arent sensory or action neurons
+class BrainKind(enum.Enum):
+    Stationary = 0  # Can never move its creature
+    PositionIndependent = 1  # Only reads sensors that don't change, so it always does the same thing
+    Dynamic = 2
+
+
+class EvaluationPlan:
+    """
+    The order in which the connections of a brain are evaluated, made once when the brain is created.
+
+    Connections that write to a hidden neuron come first, grouped in layers. A hidden neuron is in a layer after
+    every hidden neuron it reads from, except when that would make a loop, then it reads the value of the previous
+    tick. The connections that write to an action come last, in the order of the genome.
+    Connections that can never change an action are marked as not live, they are still in the plan because
+    their random sensors still have to be read.
+
+    Most brains end up with one of only a few plans, so equal plans are shared through EvaluationPlan.get
+    and a plan must never be changed after it is made.
+    """
+    __slots__ = ("order", "layer_ends", "live", "live_count", "random_reads", "recurrent", "time_invariant")
+
+    order: Sequence[int]  # Indexes of the connections
+    layer_ends: tuple[int, ...]  # Where every hidden layer ends in order, the action connections come after the last one
+    live: tuple[bool, ...]  # By connection index
+    live_count: int
+    random_reads: int  # How many times the random sensor is read by all connections together
+    recurrent: bool  # True when a live hidden neuron reads the value of the previous tick
+    time_invariant: bool  # On a board where nothing moves, this brain does exactly the same every tick
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def get(order: Sequence[int], layer_ends: tuple[int, ...], live: tuple[bool, ...], random_reads: int,
+            recurrent: bool, time_invariant: bool) -> "EvaluationPlan":
+        plan = EvaluationPlan()
+        plan.order = order
+        plan.layer_ends = layer_ends
+        plan.live = live
+        plan.live_count = sum(live)
+        plan.random_reads = random_reads
+        plan.recurrent = recurrent
+        plan.time_invariant = time_invariant
+        return plan
+
+
 def chance(value: float) -> bool:
     return value > random.random()
 
 
 class Brain:
+    __slots__ = ("creature", "connections", "mutation_factor", "kind", "plan", "hidden_state", "cached_actions")
+
     creature: "Creature"
-    sensory_neurons: list[Union[int]]
-    action_neurons: list[Union[int]]
+    sensory_neurons: tuple[int, ...] = SensoryNeuronTypes
+    action_neurons: tuple[int, ...] = ActionNeuronTypes
     connections: list[Connection]
     mutation_factor: float
+    kind: BrainKind
+    plan: EvaluationPlan
+    hidden_state: Union[array, None]  # None unless a live hidden neuron reads the value of the previous tick
+    cached_actions: Union[list[tuple[int, float]], None]  # Only used by position independent brains
 
     def __init__(self, creature: "Creature", connections: list[Connection], mutation_factor: float = 10):
         self.creature = creature
@@ -160,22 +259,163 @@ class Brain:
         self.create_brain(connections)
 
     def create_brain(self, connections):
+        # The connections are used as they are, mutations only happen in mutate_brains
         self.connections = connections
-        self.sensory_neurons = []
-        self.action_neurons = []
-        for sensory_type in SensoryNeuronTypes:
-            self.sensory_neurons.append(sensory_type)
-        for action_type in ActionNeuronTypes:
-            self.action_neurons.append(action_type)
         if len(connections) < 1:
             self.create_random_connection()
             while chance(0.1):
                 self.create_random_connection()
+        # A list that grew one append at a time has room for a few more, a copy is exactly as big as it has to be
+        self.connections = self.connections[:]
+        self.compile_plan()
+
+    def get_hidden_inputs(self, connection: Connection) -> list[int]:
+        sensory_count = len(self.sensory_neurons)
+        return [index - sensory_count for index in connection.inputs if index >= sensory_count]
+
+    def compile_plan(self):
+        # Has to be called again whenever the connections change
+        connections = self.connections
+        action_count = len(self.action_neurons)
+        incoming: dict[int, list[int]] = {}  # Hidden neuron -> indexes of the connections that write to it
+        for index, connection in enumerate(connections):
+            if connection.output >= action_count:
+                incoming.setdefault(connection.output - action_count, []).append(index)
+
+        # Depth first search over what every hidden neuron reads, reading a neuron that is still being visited
+        # means there is a loop, that read gets the value of the previous tick
+        layers: dict[int, int] = {}
+        visiting: set[int] = set()
+        recurrent_reads: set[tuple[int, int]] = set()  # (source neuron, destination neuron)
+
+        def visit(neuron: int):
+            visiting.add(neuron)
+            layer = 0
+            for index in incoming[neuron]:
+                for source in self.get_hidden_inputs(connections[index]):
+                    if source not in incoming:
+                        continue  # Nothing writes to it, so it is always 0
+                    if source in visiting:
+                        recurrent_reads.add((source, neuron))
+                        continue
+                    if source not in layers:
+                        visit(source)
+                    layer = max(layer, layers[source] + 1)
+            visiting.remove(neuron)
+            layers[neuron] = layer
+
+        for hidden_neuron in sorted(incoming):
+            if hidden_neuron not in layers:
+                visit(hidden_neuron)
+
+        # Work out between which values every hidden neuron stays, the layers are a topological order
+        neuron_ranges: dict[int, tuple[float, float]] = {}
+
+        def get_input_ranges(connection: Connection, destination: Union[int, None]) -> list[tuple[float, float]]:
+            ranges = []
+            for index in connection.inputs:
+                source = index - len(self.sensory_neurons)
+                if source < 0:
+                    ranges.append((0.0, 1.0))
+                elif source not in incoming:
+                    ranges.append((0.0, 0.0))
+                elif (source, destination) in recurrent_reads:
+                    ranges.append((-1.0, 1.0))
+                else:
+                    ranges.append(neuron_ranges[source])
+            return ranges
+
+        for hidden_neuron in sorted(layers, key=lambda neuron: layers[neuron]):
+            lowest = highest = 0.0
+            for index in incoming[hidden_neuron]:
+                connection_range = Connection.get_certainty_range(
+                    connections[index], get_input_ranges(connections[index], hidden_neuron))
+                lowest += math.tanh(connection_range[0])
+                highest += math.tanh(connection_range[1])
+            neuron_ranges[hidden_neuron] = (math.tanh(lowest), math.tanh(highest))
+
+        # A connection is live when it writes to an action that it can trigger,
+        # or to a hidden neuron that is read by a live connection
+        live = [False] * len(connections)
+        live_neurons: set[int] = set()
+        to_visit: list[int] = []
+        for index, connection in enumerate(connections):
+            if connection.output >= action_count:
+                continue
+            certainty_range = Connection.get_certainty_range(connection, get_input_ranges(connection, None))
+            if Brain.can_perform_action(self.action_neurons[connection.output], *certainty_range):
+                live[index] = True
+                to_visit.extend(self.get_hidden_inputs(connection))
+        while to_visit:
+            neuron = to_visit.pop()
+            if neuron in live_neurons or neuron not in incoming:
+                continue
+            live_neurons.add(neuron)
+            for index in incoming[neuron]:
+                live[index] = True
+                to_visit.extend(self.get_hidden_inputs(connections[index]))
+
+        if incoming:
+            order: list[int] = []
+            layer_ends: list[int] = []
+            for layer in range(max(layers.values()) + 1):
+                order.extend(index for index, connection in enumerate(connections)
+                             if connection.output >= action_count
+                             and layers[connection.output - action_count] == layer)
+                layer_ends.append(len(order))
+            order.extend(index for index, connection in enumerate(connections) if connection.output < action_count)
+            plan_order: Sequence[int] = tuple(order)
+        else:
+            # Most brains don't have hidden neurons, a range is a lot smaller than a list
+            plan_order = range(len(connections))
+            layer_ends = []
+        recurrent = any(destination in live_neurons for _, destination in recurrent_reads)
+        time_invariant = not recurrent
+        # Without a loop every hidden neuron is written before it is read, so there is nothing to keep between ticks
+        self.hidden_state = array("d", [0.0] * HiddenNeuronCount) if recurrent else None
+        self.cached_actions = None
+
+        can_move = False
+        only_constant_inputs = not recurrent
+        for index, connection in enumerate(connections):
+            if not live[index]:
+                continue
+            action_type = self.action_neurons[connection.output] if connection.output < action_count else None
+            if action_type is not None and action_type != ActionNeuronType.OSC.value:
+                can_move = True
+            if action_type == ActionNeuronType.Mrn.value:
+                time_invariant = False  # Picks a new random direction every tick
+            for input_index in connection.inputs:
+                if input_index >= len(self.sensory_neurons):
+                    continue
+                if self.sensory_neurons[input_index] not in ConstantSensorTypes:
+                    only_constant_inputs = False
+                if self.sensory_neurons[input_index] in TimeDependentSensorTypes:
+                    time_invariant = False
+
+        self.plan = EvaluationPlan.get(
+            plan_order, tuple(layer_ends), tuple(live),
+            sum(connection.inputs.count(SensoryNeuronType.Rnd.value) for connection in connections),
+            recurrent, time_invariant)
+
+        if not can_move:
+            self.kind = BrainKind.Stationary
+        elif only_constant_inputs:
+            self.kind = BrainKind.PositionIndependent
         else:
-            self.mutate_connections()
+            self.kind = BrainKind.Dynamic
+
+    @staticmethod
+    def can_perform_action(action_type: int, lowest: float, highest: float) -> bool:
+        # This has to match the conditions in perform_action
+        if action_type in (ActionNeuronType.OSC.value, ActionNeuronType.Mrn.value, ActionNeuronType.Mfd.value,
+                           ActionNeuronType.Mrv.value):
+            return highest > 0
+        # MLR, MX and MY check for `not -.8 > certainty > .8`, which is true for every certainty
+        return True
 
     def create_random_connection(self):
-        possible = list(range(len(self.sensory_neurons)))
+        possible = list(range(len(self.sensory_neurons) + HiddenNeuronCount))
         random.shuffle(possible)
         inputs: list[int] = [possible.pop()]
         weights: list[float] = [(random.random() - .5) * 2]
@@ -188,43 +428,144 @@ class Brain:
             inputs,
             weights,
             (random.random() - .5) * 2,
-            random.randrange(0, len(self.action_neurons) - 1)
+            random.randrange(0, len(self.action_neurons) + HiddenNeuronCount)
         )
 
         self.connections.append(connection)
 
-    def mutate_connections(self):
-        change_factor = 0.01 * self.mutation_factor
-        for connection in self.connections:
-            for weight_index, weight in enumerate(connection.weights):
-                connection.weights[weight_index] = weight + weight * change_factor * (random.random() - 0.5)
-                self.creature.mutate_color(1)
-            connection.bias = connection.bias + connection.bias * change_factor * (random.random() - 0.5)
-        if chance(0.01 * self.mutation_factor) and len(self.connections) > 1:
-            self.creature.mutate_color()
-            self.connections.pop(random.randrange(0, len(self.connections) - 0))
-        if chance(0.01 * self.mutation_factor):
-            self.creature.mutate_color()
-            self.create_random_connection()
-        self.mutation_factor = self.mutation_factor + change_factor * random.random()
-
-    def think(self, board: "Board"):
-
-        for connection in self.connections:
-            source_types = [self.sensory_neurons[index] for index in connection.inputs]
-            inputs: list[float] = []
-            for source_type in source_types:
-                if source_type in SensoryNeuronTypes:
-                    inputs.append(self.get_sensory_data(board, source_type))
-                elif source_type in ActionNeuronTypes:
-                    raise Exception("Source neuron type is action type")
-                else:
-                    raise Exception("Source neuron type is not sensory or action")
-            certainty = Connection.calculate_connection(connection, inputs)
+    @staticmethod
+    def mutate_brains(brains: list["Brain"]):
+        # The only place where brains mutate, for a whole generation of offspring at once.
+        # Every weight and bias changes by up to mutation_factor / 200 of itself, and a connection is removed and
+        # added with a chance of mutation_factor / 100 each. All weights and biases are mutated with one array
+        # operation, and the color of a creature is only changed once, based on the amount of mutations that happened.
+        if not brains:
+            return
+        connections = [connection for brain in brains for connection in brain.connections]
+        connection_counts = np.array([len(brain.connections) for brain in brains])
+        weight_counts = np.array([len(connection.weights) for connection in connections])
+        connection_owners = np.repeat(np.arange(len(brains)), connection_counts)
+        weight_owners = np.repeat(connection_owners, weight_counts)
+
+        mutation_factors = np.array([brain.mutation_factor for brain in brains], dtype=np.float64)
+        change_factors = 0.01 * mutation_factors
+
+        weights = np.concatenate([np.frombuffer(connection.weights) for connection in connections])
+        weights += weights * change_factors[weight_owners] * (np_random.random(len(weights)) - 0.5)
+        biases = np.array([connection.bias for connection in connections], dtype=np.float64)
+        biases += biases * change_factors[connection_owners] * (np_random.random(len(biases)) - 0.5)
+
+        weight_ends = np.cumsum(weight_counts)
+        for connection, end, count, bias in zip(connections, weight_ends.tolist(), weight_counts.tolist(),
+                                                biases.tolist()):
+            # The numpy view writes straight into the array of the connection
+            np.frombuffer(connection.weights)[:] = weights[end - count:end]
+            connection.bias = bias
+
+        removals = (np_random.random(len(brains)) < change_factors) & (connection_counts > 1)
+        additions = np_random.random(len(brains)) < change_factors
+        for index in np.flatnonzero(removals).tolist():
+            brain_connections = brains[index].connections
+            brain_connections.pop(random.randrange(0, len(brain_connections)))
+        for index in np.flatnonzero(additions).tolist():
+            brains[index].create_random_connection()
+
+        # Every weight and every added/removed connection shifts the hue by up to 0.025 with a chance of 5%.
+        # The sum of n uniform hue shifts has the same spread as one shift that is sqrt(n) times as big.
+        mutation_counts = np.bincount(weight_owners, minlength=len(brains)) + removals + additions
+        color_mutations = np_random.binomial(mutation_counts, 0.05)
+        hue_shifts = (np_random.random(len(brains)) - 0.5) * 0.05 * np.sqrt(color_mutations)
+        for index in np.flatnonzero(color_mutations).tolist():
+            brains[index].creature.shift_hue(float(hue_shifts[index]))
+
+        mutation_factors += change_factors * np_random.random(len(brains))
+        for brain, mutation_factor in zip(brains, mutation_factors.tolist()):
+            brain.mutation_factor = mutation_factor
+            brain.compile_plan()
+
+    def think(self, board: "Board", skip_dormant: bool = False):
+        # With skip_dormant, connections that can never change an action are skipped,
+        # stationary brains are skipped completely and position independent brains reuse the actions of their first think
+        plan = self.plan
+        if skip_dormant and (self.cached_actions is not None or plan.live_count == 0
+                             or self.kind == BrainKind.Stationary):
+            # Position independent brains only read the random sensor in connections that aren't live.
+            # A stationary brain can only change its own oscillator, which nothing but that brain reads
+            Brain.skip_random_reads(plan.random_reads)
+            actions = self.cached_actions or []
+        else:
+            actions = self.evaluate(board, skip_dormant)
+            if skip_dormant and self.kind == BrainKind.PositionIndependent:
+                self.cached_actions = actions
+
+        for action_type, certainty in actions:
+            self.perform_action(action_type, certainty)
+
+    def evaluate(self, board: "Board", skip_dormant: bool = False) -> list[tuple[int, float]]:
+        # Returns the actions with their certainty, in the order they have to be performed
+        plan = self.plan
+        connections = self.connections
+        sensory_count = len(self.sensory_neurons)
+
+        # Every sensor is read before anything is calculated, in the order of the plan
+        sensor_values: list[Union[list[float], None]] = [None] * len(connections)
+        for index in plan.order:
+            connection = connections[index]
+            if skip_dormant and not plan.live[index]:
+                Brain.skip_random_reads(connection.inputs.count(SensoryNeuronType.Rnd.value))
+                continue
+            sensor_values[index] = [self.get_sensory_data(board, self.sensory_neurons[input_index])
+                                    if input_index < sensory_count else 0.0 for input_index in connection.inputs]
+
+        # Only brains with a loop keep their hidden neurons between ticks, the others write every neuron before reading it
+        hidden_state = self.hidden_state
+        if hidden_state is None and plan.layer_ends:
+            hidden_state = [0.0] * HiddenNeuronCount
+        start = 0
+        for end in plan.layer_ends:
+            totals: dict[int, float] = {}
+            for index in plan.order[start:end]:
+                if sensor_values[index] is None:
+                    continue
+                connection = connections[index]
+                neuron = connection.output - len(self.action_neurons)
+                result = Connection.calculate_connection(
+                    connection, self.get_inputs(connection, sensor_values[index], hidden_state))
+                totals[neuron] = totals.get(neuron, 0.0) + result
+            # Neurons only get their new value after the whole layer, so loops read the value of the previous tick
+            for neuron, total in totals.items():
+                hidden_state[neuron] = math.tanh(total)
+            start = end
+
+        actions: list[tuple[int, float]] = []
+        for index in plan.order[start:]:
+            if sensor_values[index] is None:
+                continue
+            connection = connections[index]
+            certainty = Connection.calculate_connection(
+                connection, self.get_inputs(connection, sensor_values[index], hidden_state))
+            actions.append((self.action_neurons[connection.output], certainty))
+        return actions
+
+    def get_inputs(self, connection: Connection, sensor_values: list[float],
+                   hidden_state: Union[Sequence[float], None]) -> list[float]:
+        sensory_count = len(self.sensory_neurons)
+        inputs: list[float] = []
+        for input_index, value in zip(connection.inputs, sensor_values):
+            if input_index < sensory_count:
+                inputs.append(value)
+            elif hidden_state is not None:
+                inputs.append(hidden_state[input_index - sensory_count])
+            else:
+                inputs.append(0.0)  # Nothing writes to the hidden neurons of this brain
+        return inputs
 
-            destination_type = self.action_neurons[connection.output]
-            if destination_type in ActionNeuronTypes:
-                self.perform_action(destination_type, certainty)
+    @staticmethod
+    def skip_random_reads(count: int):
+        # The random sensor is the only one that draws random numbers, they still have to be drawn
+        # so every other creature gets the same random numbers as when nothing was skipped
+        for _ in range(count):
+            random.random()
 
     def get_sensory_data(self, board: "Board", input_type: int) -> float:
         sensor_val: Union[float, None]
@@ -234,20 +575,9 @@ class Brain:
             sensor_val = random.random()
         elif input_type == SensoryNeuronType.Osc.value:
             sensor_val = self.creature.get_osc()
-        elif input_type == SensoryNeuronType.Lx.value:
-            sensor_val = self.creature.get_pos()[0] / board.board_width
-        elif input_type == SensoryNeuronType.Ly.value:
-            sensor_val = self.creature.get_pos()[0] / board.board_height
-        elif input_type == SensoryNeuronType.BDx.value:
-            sensor_val = min(self.creature.get_distance_border_forward(board, Rotation.Left.value),
-                             self.creature.get_distance_border_forward(board,
-                                                                       Rotation.Right.value)) / board.board_height * 2
-        elif input_type == SensoryNeuronType.BDy.value:
-            sensor_val = min(self.creature.get_distance_border_forward(board, Rotation.Up.value),
-                             self.creature.get_distance_border_forward(board,
-                                                                       Rotation.Down.value)) / board.board_width * 2
-        elif input_type == SensoryNeuronType.Bfd.value:
-            sensor_val = self.creature.get_distance_border_forward(board)
+        elif input_type in PositionalSensorTypes:
+            creature = self.creature
+            sensor_val = float(board.sensor_tables.lookup(input_type, creature.x, creature.y, creature.rotation))
         elif input_type == SensoryNeuronType.Cfd.value:
             sensor_val = self.creature.get_distance_creature_forward(board)
         elif input_type == SensoryNeuronType.LMy.value:
@@ -281,7 +611,7 @@ class Brain:
         if action_type == ActionNeuronType.OSC.value and certainty > 0:
             self.creature.set_osc(certainty)
         elif action_type == ActionNeuronType.Mrn.value and certainty > 0:
-            self.creature.move(random.choice([0, 1, 2, 3]), certainty)
+            self.creature.move(move_random.choice([0, 1, 2, 3]), certainty)
         elif action_type == ActionNeuronType.Mfd.value and certainty > 0:
             creature = self.creature
             creature.move(creature.get_rotation(), certainty)
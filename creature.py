@@ -1,9 +1,11 @@
 import colorsys
+import hashlib
 import math
 import random
+import struct
 from typing import Union, TYPE_CHECKING
 
-from brain import Brain, Rotation, Connection
+from brain import Brain, Rotation, Connection, SensoryNeuronType
 
 if TYPE_CHECKING:
     from main import Board
@@ -12,6 +14,14 @@ random = random.Random()
 
 random.seed(1)
 
+# Genome layout (little endian):
+#   header:     r, g, b (uint8), mutation factor (double), connection count (uint16)
+#   connection: output (uint8), input count (uint8), bias (double),
+#               followed by the inputs (uint8 each) and the weights (double each)
+# Doubles are used so a genome survives a round trip without changing.
+GENOME_HEADER = struct.Struct("<3BdH")
+GENOME_CONNECTION = struct.Struct("<BBd")
+
 
 def will_get_out_of_bound(new_pos: tuple[int, int], screensize: tuple[int, int]) -> bool:
     if new_pos[0] < 0 or new_pos[0] >= screensize[0]:
@@ -22,14 +32,17 @@ def will_get_out_of_bound(new_pos: tuple[int, int], screensize: tuple[int, int])
 
 
 class Creature:
+    __slots__ = ("brain", "x", "y", "age", "packed_color", "rotation", "osc_period", "queued_move", "lineage_id")
+
     brain: Brain
     x: int
     y: int
     age: int
-    color: tuple[int, int, int]
+    packed_color: int  # 0xRRGGBB, one int is a lot smaller than a tuple of three
     rotation: int
     osc_period: int
     queued_move: Union[tuple[int, float], None]
+    lineage_id: int  # Id in the lineage store of the board, -1 when it isn't in one
 
     def __init__(self, location: tuple[int, int], connections: list[Connection], color: tuple[int, int, int],
                  mutation_factor: float = None):
@@ -39,9 +52,18 @@ class Creature:
         self.age = 0
         self.osc_period = 20
         self.queued_move = None
+        self.lineage_id = -1
         self.brain = Brain(self, connections, mutation_factor)
         self.rotation = random.choice([0, 1, 2, 3])
 
+    @property
+    def color(self) -> tuple[int, int, int]:
+        return self.packed_color >> 16, (self.packed_color >> 8) & 0xFF, self.packed_color & 0xFF
+
+    @color.setter
+    def color(self, color: tuple[int, int, int]):
+        self.packed_color = (color[0] << 16) | (color[1] << 8) | color[2]
+
     def get_pos(self):
         return self.x, self.y
 
@@ -55,28 +77,22 @@ class Creature:
     def get_rotation(self):
         return self.rotation
 
-    # TODO: test if this function doesnt return 1 when in the bottom right corner
     # I named it get_distance_border_forward, but you can pass an optional parameter to set a custom rotation
+    # Without division it returns the amount of tiles between the creature and the border,
+    # with division it returns the Bfd sensor from the sensor tables of the board.
     def get_distance_border_forward(self, board: "Board", rotation: Union[int, None] = None,
                                     disable_division: Union[bool, None] = None) -> Union[int, float]:
-        board_size = board.get_board_size()
-        rot: int = rotation or self.rotation
+        rot: int = self.rotation if rotation is None else rotation
+        if not disable_division:
+            return float(board.sensor_tables.lookup(SensoryNeuronType.Bfd.value, self.x, self.y, rot))
         if rot == Rotation.Left.value:
-            if disable_division:
-                return self.x
-            return self.x / board.board_width
+            return self.x
         elif rot == Rotation.Right.value:
-            if disable_division:
-                return board_size[0] - self.x
-            return board_size[0] - self.x / board.board_width
+            return board.board_width - 1 - self.x
         elif rot == Rotation.Up.value:
-            if disable_division:
-                return self.y
-            return self.y / board.board_width
+            return self.y
         elif rot == Rotation.Down.value:
-            if disable_division:
-                return board_size[1] - self.y
-            return board_size[1] - self.y / board.board_width
+            return board.board_height - 1 - self.y
         else:
             raise Exception("Rotation invalid")
 
@@ -161,17 +177,20 @@ class Creature:
         creature = args[0]
         board = args[1]
         creature.queued_move = None
-        creature.brain.think(board)
-        if not creature.queued_move:
-            return creature, None
-        new_pos = creature.get_new_pos(creature.queued_move[0])
+        creature.brain.think(board, board.skip_dormant)
+        return creature, creature.get_queued_pos(board)
+
+    def get_queued_pos(self, board: "Board") -> Union[None, tuple[int, int]]:
+        if not self.queued_move:
+            return None
+        new_pos = self.get_new_pos(self.queued_move[0])
         if will_get_out_of_bound(new_pos, board.get_board_size()):
-            return creature, None
-        elif new_pos == creature.get_pos():
-            return creature, None
-        return creature, new_pos
+            return None
+        elif new_pos == self.get_pos():
+            return None
+        return new_pos
 
-    def reproduce(self):
+    def reproduce(self, mutate: bool = True):
         def cloned_connections(connections: list[Connection]):
             res = []
             for conn in connections:
@@ -191,15 +210,42 @@ class Creature:
                                 cloned_connections(self.brain.get_connections()),
                                 cloned_tup(self.color),
                                 self.brain.get_mutation_factor())
+        if mutate:
+            # Offspring of a whole generation should be mutated together, see Board.tick_round
+            Brain.mutate_brains([new_creature.brain])
         return new_creature
 
-    def mutate_color(self, strength: int = 5):
-        if random.random() < 0.95:
-            return
+    def get_genome(self) -> bytes:
+        connections = self.brain.get_connections()
+        parts = [GENOME_HEADER.pack(*self.color, self.brain.get_mutation_factor(), len(connections))]
+        for conn in connections:
+            count = len(conn.inputs)
+            parts.append(GENOME_CONNECTION.pack(conn.output, count, conn.bias))
+            parts.append(struct.pack(f"<{count}B{count}d", *conn.inputs, *conn.weights))
+        return b"".join(parts)
+
+    def get_genome_hash(self) -> int:
+        # hash() of bytes changes every time python starts, this one doesn't
+        return int.from_bytes(hashlib.blake2b(self.get_genome(), digest_size=8).digest(), "little")
 
+    @staticmethod
+    def from_genome(location: tuple[int, int], genome: bytes) -> "Creature":
+        # The genome is copied as is, mutations already happened when its owner was born
+        r, g, b, mutation_factor, connection_count = GENOME_HEADER.unpack_from(genome, 0)
+        offset = GENOME_HEADER.size
+        connections: list[Connection] = []
+        for _ in range(connection_count):
+            output, count, bias = GENOME_CONNECTION.unpack_from(genome, offset)
+            offset += GENOME_CONNECTION.size
+            values = struct.unpack_from(f"<{count}B{count}d", genome, offset)
+            offset += count + count * 8
+            connections.append(Connection.create_connection(list(values[:count]), list(values[count:]), bias, output))
+        return Creature(location, connections, (r, g, b), mutation_factor)
+
+    def shift_hue(self, amount: float):
         h, s, v = colorsys.rgb_to_hsv(self.color[0] / float(256), self.color[1] / float(256),
                                       self.color[2] / float(256))
-        h += ((random.random() - 0.5) * 0.05)
+        h += amount
         r, g, b = colorsys.hsv_to_rgb(h, s, v)
 
         def clamp(color: int):
@@ -210,8 +256,3 @@ class Creature:
             clamp(round(g * 255)),
             clamp(round(b * 255)),
         )
-        # self.color = (
-        #     clamp(color[0] + random.randrange(-strength, strength), 0, 255),
-        #     clamp(color[1] + random.randrange(-strength, strength), 0, 255),
-        #     clamp(color[2] + random.randrange(-strength, strength), 0, 255)
-        # )
@@ -0,0 +1,202 @@
+# Runs the object engine (Board without any of the shortcuts) next to a candidate engine from the same seed and
+# compares them after every step, so a faster engine can't silently change how the creatures evolve.
+# Both engines use the same module level random instances, so their random states are swapped in and out around
+# every step. A candidate that draws more or fewer random numbers than the reference diverges as well.
+#
+# With per_step the candidate runs tick by tick like the reference. Without it the candidate runs run_generation,
+# which skips the rest of a generation once the board is static (is_static and skip_ticks), and the boards are only
+# compared at the end of every generation. With a migration_interval both boards also swap part of their population
+# for genomes sampled from themselves (sample_genomes and replace_creatures, like islands.py does).
+#
+# The reference also mutates offspring with Brain.mutate_brains, the batched mutation is not checked by this.
+# usage: python differential.py [generations] [seed] [generation]
+import sys
+from typing import Callable, Union
+
+from board import Board, seed_random, get_random_state, set_random_state
+from brain import BrainKind
+from creature import Creature
+
+RandomStateNames = ("board", "creature", "brain", "move", "numpy")  # Same order as get_random_state
+CreatureFields = ("x", "y", "rotation", "osc_period", "genome")
+
+
+class DifferentialConfig:
+    board_size: tuple[int, int]
+    steps_per_generation: int
+    creature_count: int
+    mutation_factor: float
+    generations: int
+    seed: int
+    per_step: bool  # Otherwise the candidate runs a generation at a time with Board.run_generation
+    migration_interval: int  # Generations between migrations, 0 for none
+    migration_rate: float
+
+    def __init__(self, board_size: tuple[int, int], steps_per_generation: int, creature_count: int,
+                 mutation_factor: float, generations: int, seed: int = 1, per_step: bool = True,
+                 migration_interval: int = 0, migration_rate: float = 0.1):
+        self.board_size = board_size
+        self.steps_per_generation = steps_per_generation
+        self.creature_count = creature_count
+        self.mutation_factor = mutation_factor
+        self.generations = generations
+        self.seed = seed
+        self.per_step = per_step
+        self.migration_interval = migration_interval
+        self.migration_rate = migration_rate
+
+
+EngineFactory = Callable[[DifferentialConfig], Board]
+
+
+def reference_engine(config: DifferentialConfig) -> Board:
+    # The plain object code is the specification of how the simulation behaves
+    return Board(config.board_size, config.steps_per_generation, config.creature_count, config.mutation_factor,
+                 False, skip_dormant=False, batched=False)
+
+
+def fast_engine(config: DifferentialConfig) -> Board:
+    return Board(config.board_size, config.steps_per_generation, config.creature_count, config.mutation_factor,
+                 False)
+
+
+def get_creature_state(creature: Creature) -> tuple:
+    # Same order as CreatureFields. Engines that skip stationary brains don't keep their oscillator up to date,
+    # nothing but the brain itself can see it
+    osc_period = None if creature.brain.kind == BrainKind.Stationary else creature.osc_period
+    return creature.x, creature.y, creature.rotation, osc_period, creature.get_genome()
+
+
+def describe_creature(creature: Creature) -> str:
+    lines = [f"  lineage {creature.lineage_id}, pos ({creature.x}, {creature.y}), rotation {creature.rotation}, "
+             f"osc period {creature.osc_period}, age {creature.age}, color {creature.color}, "
+             f"mutation factor {creature.brain.get_mutation_factor()}"]
+    for connection in creature.brain.get_connections():
+        lines.append(f"    {list(connection.inputs)} -> {connection.output}: weights {list(connection.weights)}, "
+                     f"bias {connection.bias}")
+    return "\n".join(lines)
+
+
+class Divergence:
+    generation: int
+    step: int
+    phase: str  # "tick", "tick_round", "run_generation" or "migration"
+    reason: str
+    index: Union[int, None]  # Of the creature that differs, None when the whole board differs
+    reference: Board
+    candidate: Board
+
+    def __init__(self, generation: int, step: int, phase: str, reason: str, index: Union[int, None],
+                 reference: Board, candidate: Board):
+        self.generation = generation
+        self.step = step
+        self.phase = phase
+        self.reason = reason
+        self.index = index
+        self.reference = reference
+        self.candidate = candidate
+
+    def __str__(self):
+        lines = [f"Engines diverged after {self.phase} in generation {self.generation}, step {self.step}: "
+                 f"{self.reason}"]
+        if self.index is not None:
+            lines.append(f"reference creature {self.index}:")
+            lines.append(describe_creature(self.reference.get_creatures()[self.index]))
+            lines.append(f"candidate creature {self.index}:")
+            lines.append(describe_creature(self.candidate.get_creatures()[self.index]))
+        return "\n".join(lines)
+
+
+def compare_boards(reference: Board, candidate: Board, reference_random: tuple, candidate_random: tuple,
+                   phase: str) -> Union[Divergence, None]:
+    def diverged(reason: str, index: Union[int, None] = None) -> Divergence:
+        return Divergence(reference.get_gen(), reference.get_step(), phase, reason, index, reference, candidate)
+
+    if (reference.get_gen(), reference.get_step()) != (candidate.get_gen(), candidate.get_step()):
+        return diverged(f"candidate is at generation {candidate.get_gen()}, step {candidate.get_step()}")
+    reference_creatures = reference.get_creatures()
+    candidate_creatures = candidate.get_creatures()
+    if len(reference_creatures) != len(candidate_creatures):
+        return diverged(f"{len(reference_creatures)} creatures in the reference, {len(candidate_creatures)} in the "
+                        f"candidate")
+
+    for index, (reference_creature, candidate_creature) in enumerate(zip(reference_creatures, candidate_creatures)):
+        reference_state = get_creature_state(reference_creature)
+        candidate_state = get_creature_state(candidate_creature)
+        if reference_state == candidate_state:
+            continue
+        fields = [name for name, reference_value, candidate_value in
+                  zip(CreatureFields, reference_state, candidate_state) if reference_value != candidate_value]
+        return diverged(f"creature {index} has a different {', '.join(fields)}", index)
+
+    # Checked last, a different position usually explains a different random state
+    for name, reference_state, candidate_state in zip(RandomStateNames, reference_random, candidate_random):
+        if reference_state != candidate_state:
+            return diverged(f"the {name} random state differs, the candidate drew a different amount of numbers")
+    return None
+
+
+def run_differential(config: DifferentialConfig, candidate_engine: EngineFactory = fast_engine,
+                     reference_engine_factory: EngineFactory = reference_engine) -> Union[Divergence, None]:
+    # Returns the first divergence, or None when both engines did exactly the same for every generation
+    seed_random(config.seed)
+    reference = reference_engine_factory(config)
+    reference_random = get_random_state()
+    seed_random(config.seed)
+    candidate = candidate_engine(config)
+    candidate_random = get_random_state()
+
+    def step(phase: str, reference_action: Callable[[Board], None],
+             candidate_action: Callable[[Board], None]) -> Union[Divergence, None]:
+        nonlocal reference_random, candidate_random
+        set_random_state(reference_random)
+        reference_action(reference)
+        reference_random = get_random_state()
+        set_random_state(candidate_random)
+        candidate_action(candidate)
+        candidate_random = get_random_state()
+        return compare_boards(reference, candidate, reference_random, candidate_random, phase)
+
+    def run_every_tick(board: Board):
+        for _ in range(config.steps_per_generation):
+            board.tick()
+        board.tick_round()
+
+    def migrate(board: Board):
+        board.replace_creatures(board.sample_genomes(
+            min(len(board.get_creatures()), round(len(board.get_creatures()) * config.migration_rate))))
+
+    phases: list[tuple[str, Callable[[Board], None], Callable[[Board], None]]] = []
+    if config.per_step:
+        phases += [("tick", Board.tick, Board.tick)] * config.steps_per_generation
+        phases.append(("tick_round", Board.tick_round, Board.tick_round))
+    else:
+        phases.append(("run_generation", run_every_tick, Board.run_generation))
+
+    try:
+        divergence = compare_boards(reference, candidate, reference_random, candidate_random, "init")
+        for generation in range(config.generations):
+            generation_phases = phases
+            if config.migration_interval and (generation + 1) % config.migration_interval == 0:
+                generation_phases = phases + [("migration", migrate, migrate)]
+            for phase, reference_action, candidate_action in generation_phases:
+                if divergence is not None:
+                    return divergence
+                divergence = step(phase, reference_action, candidate_action)
+        return divergence
+    finally:
+        reference.close()
+        candidate.close()
+
+
+if __name__ == '__main__':
+    differential_config = DifferentialConfig((30, 30), 30, 180, 10, int(sys.argv[1]) if len(sys.argv) > 1 else 20,
+                                             int(sys.argv[2]) if len(sys.argv) > 2 else 1,
+                                             per_step=len(sys.argv) <= 3 or sys.argv[3] != "generation",
+                                             migration_interval=5)
+    first_divergence = run_differential(differential_config)
+    if first_divergence is None:
+        print(f"No divergence in {differential_config.generations} generations")
+    else:
+        print(first_divergence)
+        sys.exit(1)
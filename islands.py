@@ -0,0 +1,106 @@
+# Island model: every island is its own Board running in its own process, with its own selection.
+# Every few generations each island sends a part of its population to the next island in the ring,
+# the genomes travel as compact bytes (see Creature.get_genome) so the processes don't have to pickle creatures.
+import multiprocessing
+import queue
+from multiprocessing import Queue
+
+from board import Board, seed_random
+
+
+class IslandConfig:
+    island_count: int
+    board_size: tuple[int, int]
+    steps_per_generation: int
+    creature_count: int
+    mutation_factor: float
+    generations: int
+    migration_interval: int
+    migration_rate: float
+    seed: int
+
+    def __init__(self, island_count: int, board_size: tuple[int, int], steps_per_generation: int,
+                 creature_count: int, mutation_factor: float, generations: int, migration_interval: int = 5,
+                 migration_rate: float = 0.1, seed: int = 1):
+        self.island_count = island_count
+        self.board_size = board_size
+        self.steps_per_generation = steps_per_generation
+        self.creature_count = creature_count
+        self.mutation_factor = mutation_factor
+        self.generations = generations
+        self.migration_interval = migration_interval
+        self.migration_rate = migration_rate
+        self.seed = seed
+
+    def get_migrant_count(self, population: int) -> int:
+        return min(population, round(population * self.migration_rate))
+
+
+class IslandResult:
+    index: int
+    generation: int
+    genomes: list[bytes]
+
+    def __init__(self, index: int, generation: int, genomes: list[bytes]):
+        self.index = index
+        self.generation = generation
+        self.genomes = genomes
+
+    def get_diversity(self) -> float:
+        # Fraction of the population that has a unique genome
+        if not self.genomes:
+            return 0.0
+        return len(set(self.genomes)) / len(self.genomes)
+
+
+def island(index: int, config: IslandConfig, inboxes: list[Queue], results: Queue):
+    # Without reseeding every forked island would evolve exactly the same way
+    seed_random(config.seed + index)
+    board = Board(config.board_size, config.steps_per_generation, config.creature_count, config.mutation_factor,
+                  False)
+    next_inbox = inboxes[(index + 1) % config.island_count]
+
+    for generation in range(config.generations):
+        board.run_generation()
+
+        if config.island_count < 2 or (generation + 1) % config.migration_interval != 0:
+            continue
+        # Queues buffer in a feeder thread, so every island can send before it receives without deadlocking
+        next_inbox.put(board.sample_genomes(config.get_migrant_count(len(board.get_creatures()))))
+        board.replace_creatures(inboxes[index].get())
+
+    results.put(IslandResult(index, board.get_gen(), [creature.get_genome() for creature in board.get_creatures()]))
+
+
+def run_islands(config: IslandConfig, poll_interval: float = 1.0) -> list[IslandResult]:
+    # Raises when an island crashes, its neighbour would wait for migrants forever, so every island is stopped
+    inboxes = [Queue() for _ in range(config.island_count)]
+    results = Queue()
+    processes = [multiprocessing.Process(target=island, args=(index, config, inboxes, results))
+                 for index in range(config.island_count)]
+    for process in processes:
+        process.start()
+    try:
+        # Collect before joining, a process that still has data in a queue won't exit
+        island_results: list[IslandResult] = []
+        while len(island_results) < len(processes):
+            try:
+                island_results.append(results.get(timeout=poll_interval))
+            except queue.Empty:
+                for index, process in enumerate(processes):
+                    if process.exitcode not in (None, 0):
+                        raise Exception(f"Island {index} stopped with exit code {process.exitcode}")
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+    return sorted(island_results, key=lambda result: result.index)
+
+
+if __name__ == '__main__':
+    island_config = IslandConfig(multiprocessing.cpu_count(), (30, 30), 15, 180, 10, 20)
+    for island_result in run_islands(island_config):
+        print(f"Island {island_result.index}: gen {island_result.generation}, "
+              f"{len(island_result.genomes)} creatures, diversity {island_result.get_diversity():0.2f}")
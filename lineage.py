@@ -0,0 +1,199 @@
+# Keeps track of who descends from who, without keeping the creatures themselves around.
+# Every birth is one fixed width row, the rows live in a ring buffer so memory stays bounded.
+# When the oldest rows are overwritten, the rows of creatures that already died are appended to a file (if there is
+# one). Creatures that are still alive are kept aside until they die, so a row in the file never changes anymore.
+# There are never more of those than there are creatures on the board.
+# usage: python lineage.py checks the lineage queries against a simple walk over the parents
+import enum
+import os
+from typing import Union
+
+import numpy as np
+
+
+class Fate(enum.Enum):
+    Alive = 0
+    Died = 1
+
+
+LineageRow = np.dtype([
+    ("id", "<i8"),
+    ("parent", "<i8"),  # -1 when the creature has no parent on this board
+    ("generation", "<i4"),  # Generation the creature was born in
+    ("death", "<i4"),  # Generation the creature died in, -1 while it is alive
+    ("genome_hash", "<u8"),
+    ("fate", "u1"),
+])
+
+
+class LineageStore:
+    rows: np.ndarray
+    capacity: int
+    next_id: int
+    path: Union[str, None]
+    survivors: dict[int, np.void]  # Creatures that are still alive but don't fit in the ring buffer anymore
+
+    def __init__(self, capacity: int = 100_000, path: Union[str, None] = None):
+        self.rows = np.zeros(capacity, LineageRow)
+        self.capacity = capacity
+        self.next_id = 0
+        self.path = path
+        self.survivors = {}
+
+    def get_oldest_id(self) -> int:
+        return max(0, self.next_id - self.capacity)
+
+    def is_retained(self, creature_id: int) -> bool:
+        return self.get_oldest_id() <= creature_id < self.next_id
+
+    def record_births(self, parents: list[int], generation: int, genome_hashes: list[int]) -> list[int]:
+        count = len(parents)
+        if count > self.capacity:
+            raise Exception("More births at once than the lineage store can hold")
+        ids = np.arange(self.next_id, self.next_id + count)
+        slots = ids % self.capacity
+        if self.next_id + count > self.capacity:
+            # The rows in these slots are about to be overwritten
+            evicted_rows = self.rows[slots[ids - self.capacity >= 0]]
+            alive = evicted_rows["fate"] == Fate.Alive.value
+            for row in evicted_rows[alive]:
+                self.survivors[int(row["id"])] = row
+            self.archive(evicted_rows[~alive])
+
+        new_rows = self.rows[slots]
+        new_rows["id"] = ids
+        new_rows["parent"] = parents
+        new_rows["generation"] = generation
+        new_rows["death"] = -1
+        new_rows["genome_hash"] = genome_hashes
+        new_rows["fate"] = Fate.Alive.value
+        self.rows[slots] = new_rows
+        self.next_id += count
+        return ids.tolist()
+
+    def record_deaths(self, creature_ids: list[int], generation: int):
+        ids = np.array(creature_ids, dtype=np.int64)
+        died_survivors = [self.survivors.pop(creature_id) for creature_id in ids.tolist()
+                          if creature_id in self.survivors]
+        for row in died_survivors:
+            row["death"] = generation
+            row["fate"] = Fate.Died.value
+        if died_survivors:
+            self.archive(np.array(died_survivors, dtype=LineageRow))
+
+        ids = ids[(ids >= self.get_oldest_id()) & (ids < self.next_id)]
+        slots = ids % self.capacity
+        self.rows["death"][slots] = generation
+        self.rows["fate"][slots] = Fate.Died.value
+
+    def archive(self, rows: np.ndarray):
+        # Only rows that won't change anymore, without a file they are gone
+        if self.path is not None and len(rows):
+            with open(self.path, "ab") as file:
+                rows.tofile(file)
+
+    def get_archived_rows(self) -> np.ndarray:
+        # Sorted by id, read again from the file every call
+        if self.path is None or not os.path.exists(self.path):
+            return np.zeros(0, LineageRow)
+        rows = np.fromfile(self.path, LineageRow)
+        return rows[np.argsort(rows["id"], kind="stable")]
+
+    def get_row(self, creature_id: int, archived_rows: Union[np.ndarray, None] = None) -> Union[np.void, None]:
+        # Pass the result of get_archived_rows to also find creatures that are only in the file
+        if self.is_retained(creature_id):
+            return self.rows[creature_id % self.capacity]
+        if creature_id in self.survivors:
+            return self.survivors[creature_id]
+        if archived_rows is not None:
+            index = np.searchsorted(archived_rows["id"], creature_id)
+            if index < len(archived_rows) and archived_rows["id"][index] == creature_id:
+                return archived_rows[index]
+        return None
+
+    def get_retained_rows(self) -> np.ndarray:
+        # Sorted from old to new
+        if self.next_id <= self.capacity:
+            return self.rows[:self.next_id]
+        start = self.next_id % self.capacity
+        return np.concatenate((self.rows[start:], self.rows[:start]))
+
+    def get_all_rows(self, include_archive: bool = True) -> np.ndarray:
+        # The survivors and the ring buffer, and the file with include_archive, sorted by id
+        parts = [np.array(list(self.survivors.values()), dtype=LineageRow), self.get_retained_rows()]
+        if include_archive:
+            parts.insert(0, self.get_archived_rows())
+        rows = np.concatenate(parts)
+        return rows[np.argsort(rows["id"], kind="stable")]
+
+    def get_ancestors(self, creature_id: int, generations: int, include_archive: bool = False) -> list[int]:
+        # Parent first, stops early when an ancestor isn't stored anymore
+        archived_rows = self.get_archived_rows() if include_archive else None
+        ancestors: list[int] = []
+        row = self.get_row(creature_id, archived_rows)
+        while row is not None and len(ancestors) < generations and row["parent"] >= 0:
+            parent = int(row["parent"])
+            ancestors.append(parent)
+            row = self.get_row(parent, archived_rows)
+        return ancestors
+
+    def get_descendants(self, creature_id: int, include_archive: bool = False) -> np.ndarray:
+        # Every round adds one more generation of children, parents are always older than their children.
+        # The survivors are always searched, they are the oldest creatures that are still alive
+        rows = self.get_all_rows(include_archive)
+        rows = rows[rows["id"] > creature_id]
+        in_lineage = np.zeros(len(rows), bool)
+        lineage_ids = np.array([creature_id], dtype=np.int64)
+        while True:
+            found = ~in_lineage & np.isin(rows["parent"], lineage_ids)
+            if not found.any():
+                return rows[in_lineage]
+            in_lineage |= found
+            lineage_ids = rows["id"][found]
+
+    def count_surviving_descendants(self, creature_id: int, include_archive: bool = False) -> int:
+        descendants = self.get_descendants(creature_id, include_archive)
+        return int(np.count_nonzero(descendants["fate"] == Fate.Alive.value))
+
+
+if __name__ == '__main__':
+    # Checks the queries against walking the parents of every row one by one, after the ring buffer wrapped a few times
+    import os
+    import tempfile
+
+    from board import Board, seed_random
+
+    seed_random(1)
+    with tempfile.TemporaryDirectory() as directory:
+        for path in (None, os.path.join(directory, "lineage.bin")):
+            board = Board((16, 16), 5, 40, 10, False, log_capacity=100, log_path=path)
+            for _ in range(20):
+                board.run_generation()
+            store = board.logs
+            for include_archive in (False, True):
+                # Built without get_all_rows, which is what is being checked
+                parts = [store.get_retained_rows(), np.array(list(store.survivors.values()), dtype=LineageRow)]
+                if include_archive:
+                    parts.append(store.get_archived_rows())
+                rows = np.concatenate(parts)
+                parents = dict(zip(rows["id"].tolist(), rows["parent"].tolist()))
+                alive = set(rows["id"][rows["fate"] == Fate.Alive.value].tolist())
+
+                def descends_from(descendant: int, ancestor: int) -> bool:
+                    while descendant in parents and parents[descendant] >= 0:
+                        descendant = parents[descendant]
+                        if descendant == ancestor:
+                            return True
+                    return False
+
+                # Also the ids that aren't stored anymore, their stored descendants can still be found
+                for creature_id in range(store.next_id):
+                    expected = sorted(other for other in parents if descends_from(other, creature_id))
+                    found = store.get_descendants(creature_id, include_archive)["id"].tolist()
+                    if found != expected:
+                        raise Exception(f"Descendants of {creature_id} are {found}, expected {expected}")
+                    surviving = store.count_surviving_descendants(creature_id, include_archive)
+                    if surviving != len(alive.intersection(expected)):
+                        raise Exception(f"Wrong amount of surviving descendants for {creature_id}")
+                print(f"log_path={path}, include_archive={include_archive}: {len(rows)} rows match, "
+                      f"{len(store.survivors)} survivors")
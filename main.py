@@ -41,11 +41,16 @@ def simulator(queue: Queue, board_size: tuple[int, int], steps_per_gen: int, pop
             except Empty:
                 board.tick()
                 screen.display(board)
+                if board.is_static():
+                    # Nothing will move anymore this generation, so the remaining steps can be skipped
+                    board.skip_ticks(steps_per_gen - step - 1)
+                    break
         if Stop:
             break
         board.tick_round()
         screen.display(board)
         gen += 1
+    board.close()
     screen.destroy()
 
 
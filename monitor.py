@@ -0,0 +1,146 @@
+# Publishes the state of a running board in shared memory, so other processes can watch it
+# without taking the GIL of the simulation.
+#
+# The segment has a small header and two buffers. The writer always fills the buffer that readers aren't supposed
+# to look at and then bumps the sequence number, the latest state is in buffer sequence % 2 (a seqlock).
+# A reader copies that buffer and checks the sequence again, if it changed the writer might have started
+# overwriting the copied buffer, so it tries again.
+# usage: python monitor.py <name of the shared memory>
+import sys
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import TYPE_CHECKING, Union
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from board import Board
+
+MAGIC = 0x4D495342  # "BSIM"
+published_names: set[str] = set()  # Segments created by this process
+TimingNames = ("tick", "think", "free tiles", "moving")
+
+Header = np.dtype([
+    ("magic", "<u4"),
+    ("capacity", "<u4"),
+    ("sequence", "<u8"),  # Amount of finished writes
+])
+StateHeader = np.dtype([
+    ("count", "<u4"),
+    ("generation", "<u4"),
+    ("step", "<u8"),
+    ("timings", "<f8", (len(TimingNames),)),  # Seconds, same order as TimingNames
+])
+
+
+def get_buffer_dtype(capacity: int) -> np.dtype:
+    return np.dtype([
+        ("state", StateHeader),
+        ("x", "<i4", (capacity,)),
+        ("y", "<i4", (capacity,)),
+        ("color", "<u4", (capacity,)),  # 0xRRGGBB, same as Creature.packed_color
+    ])
+
+
+class Snapshot:
+    generation: int
+    step: int
+    timings: dict[str, float]
+    x: np.ndarray
+    y: np.ndarray
+    color: np.ndarray
+
+    def __init__(self, buffer: np.void):
+        state = buffer["state"]
+        count = int(state["count"])
+        self.generation = int(state["generation"])
+        self.step = int(state["step"])
+        self.timings = dict(zip(TimingNames, state["timings"].tolist()))
+        self.x = buffer["x"][:count].copy()
+        self.y = buffer["y"][:count].copy()
+        self.color = buffer["color"][:count].copy()
+
+
+class SharedStatePublisher:
+    memory: SharedMemory
+    header: np.ndarray
+    buffers: np.ndarray
+    capacity: int
+
+    def __init__(self, name: str, capacity: int):
+        buffer_dtype = get_buffer_dtype(capacity)
+        self.capacity = capacity
+        self.memory = SharedMemory(name, create=True, size=Header.itemsize + 2 * buffer_dtype.itemsize)
+        published_names.add(name)
+        self.header = np.ndarray((), Header, self.memory.buf)
+        self.buffers = np.ndarray((2,), buffer_dtype, self.memory.buf, offset=Header.itemsize)
+        self.header["capacity"] = capacity
+        self.header["sequence"] = 0
+        self.header["magic"] = MAGIC
+
+    def publish(self, board: "Board"):
+        creatures = board.get_creatures()
+        count = min(len(creatures), self.capacity)
+        sequence = int(self.header["sequence"])
+        buffer = self.buffers[(sequence + 1) % 2]
+        buffer["state"]["count"] = count
+        buffer["state"]["generation"] = board.get_gen()
+        buffer["state"]["step"] = board.get_step()
+        buffer["state"]["timings"] = board.timings
+        buffer["x"][:count] = np.fromiter((creature.x for creature in creatures), np.int32, count)
+        buffer["y"][:count] = np.fromiter((creature.y for creature in creatures), np.int32, count)
+        buffer["color"][:count] = np.fromiter((creature.packed_color for creature in creatures), np.uint32, count)
+        # Readers only look at the other buffer until this is written
+        self.header["sequence"] = sequence + 1
+
+    def close(self):
+        del self.header, self.buffers  # The views have to be gone before the memory can be closed
+        self.memory.close()
+        self.memory.unlink()
+        published_names.discard(self.memory.name)
+
+
+class SharedStateReader:
+    memory: SharedMemory
+    header: np.ndarray
+    buffers: np.ndarray
+
+    def __init__(self, name: str):
+        self.memory = SharedMemory(name)
+        if name not in published_names:
+            # The resource tracker would remove the segment when this process exits, the simulation owns it
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.header = np.ndarray((), Header, self.memory.buf)
+        if self.header["magic"] != MAGIC:
+            raise Exception(f"Shared memory {name} doesn't contain a board")
+        buffer_dtype = get_buffer_dtype(int(self.header["capacity"]))
+        self.buffers = np.ndarray((2,), buffer_dtype, self.memory.buf, offset=Header.itemsize)
+
+    def read(self, retries: int = 100) -> Union[Snapshot, None]:
+        # Returns None when nothing has been published yet or the writer kept overwriting the buffer
+        for _ in range(retries):
+            sequence = int(self.header["sequence"])
+            if sequence == 0:
+                return None
+            snapshot = Snapshot(self.buffers[sequence % 2])
+            if int(self.header["sequence"]) == sequence:
+                return snapshot
+        return None
+
+    def close(self):
+        del self.header, self.buffers
+        self.memory.close()
+
+
+if __name__ == '__main__':
+    reader = SharedStateReader(sys.argv[1])
+    try:
+        while True:
+            latest = reader.read()
+            if latest is not None:
+                timings = ", ".join(f"{name} {seconds * 1000:0.2f}ms" for name, seconds in latest.timings.items())
+                print(f"gen {latest.generation} step {latest.step}: {len(latest.x)} creatures, {timings}")
+            time.sleep(1)
+    except KeyboardInterrupt:
+        reader.close()
@@ -0,0 +1,249 @@
+# Evaluates the brains of the whole population at once.
+# The evaluation plans of all brains are combined in arrays, one set of arrays per hidden layer and one for the actions,
+# so a tick costs a few numpy operations per layer instead of a few python calls per connection.
+# Every sensor is worked out once per tick for the whole population and then copied to the inputs that read it.
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+import brain
+from brain import SensoryNeuronType, PositionalSensorTypes, HiddenNeuronCount, Rotation
+
+if TYPE_CHECKING:
+    from board import Board
+    from creature import Creature
+
+# Same values as Brain.get_sensory_data, by rotation (Up, Right, Down, Left)
+LastMovementY = np.array([0.5, 1.0, 0.5, 0.0])
+LastMovementX = np.array([1.0, 0.5, 0.0, 0.5])
+
+# Creature.get_pop_density(board, 2, False) counts every creature that is at most 2 tiles to the left and above
+PopulationRadius = 2
+# Per rotation (Up, Right, Down, Left): does Cfd look along the row of the creature, and the sign of the direction
+LooksAlongRow = np.array([True, False, True, False])
+
+
+def clamp_sensor(values: np.ndarray) -> np.ndarray:
+    # Same as the end of Brain.get_sensory_data, values just outside of 0..1 are kept
+    return np.where((values < -0.01) | (values > 1.01), np.clip(values, 0.0, 1.0), values)
+
+
+def get_population_density(occupied: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    # Creatures at or after (x - 2, y - 2) on both axes, summed from the bottom right corner of the board
+    after = occupied[::-1, ::-1].cumsum(0).cumsum(1)[::-1, ::-1]
+    counts = after[np.maximum(xs - PopulationRadius, 0), np.maximum(ys - PopulationRadius, 0)]
+    return clamp_sensor(counts / ((PopulationRadius * 2) ** 2))
+
+
+def get_distance_creature_forward(board: "Board", occupied: np.ndarray, xs: np.ndarray, ys: np.ndarray,
+                                  rotations: np.ndarray, owners: np.ndarray) -> np.ndarray:
+    # Same as Creature.get_distance_creature_forward for the given creatures.
+    # That starts at the amount of tiles to the border, facing up or down every other creature in the same row
+    # (in the order of the creatures) makes it min(distance, abs(dx)) / height, so the order matters.
+    # Facing left or right any other creature in the same column makes it min(distance, 0) / width = 0.
+    owner_xs = xs[owners]
+    owner_ys = ys[owners]
+    owner_rotations = rotations[owners]
+    width, height = board.board_width, board.board_height
+    border = np.select([owner_rotations == Rotation.Left.value, owner_rotations == Rotation.Right.value,
+                        owner_rotations == Rotation.Up.value],
+                       [owner_xs, width - 1 - owner_xs, owner_ys], height - 1 - owner_ys).astype(np.float64)
+
+    along_row = LooksAlongRow[owner_rotations]
+    in_column = occupied[owner_xs].sum(axis=1) > 1
+    distances = np.where(~along_row & in_column, 0.0, border)
+
+    # Creatures sorted by row, in the order of the creatures within every row
+    by_row = np.argsort(ys, kind="stable")
+    row_starts = np.searchsorted(ys[by_row], np.arange(height))
+    row_ends = np.searchsorted(ys[by_row], np.arange(height), side="right")
+    row_owners = owners[along_row]
+    row_distances = distances[along_row]
+    starts = row_starts[ys[row_owners]]
+    ends = row_ends[ys[row_owners]]
+    for offset in range(int((ends - starts).max(initial=0))):
+        positions = starts + offset
+        valid = positions < ends
+        others = by_row[np.minimum(positions, len(by_row) - 1)]
+        valid &= others != row_owners
+        shrunk = np.minimum(row_distances, np.abs(xs[row_owners] - xs[others])) / height
+        row_distances = np.where(valid, shrunk, row_distances)
+    distances[along_row] = row_distances
+    return clamp_sensor(distances)
+
+
+class Layer:
+    # Row i is one connection, padded with zero weights up to the connection with the most inputs
+    owners: np.ndarray  # Index of the creature
+    outputs: np.ndarray  # Hidden layers: index in neurons, action layer: action type
+    neurons: np.ndarray  # Position in the values of the hidden neurons this layer writes to
+    weights: np.ndarray
+    sources: np.ndarray  # Position in the values of every input
+    counts: np.ndarray
+    biases: np.ndarray
+
+    def __init__(self, rows: list[tuple[int, int, list[float], list[int], float]], padding_source: int):
+        width = max((len(row[2]) for row in rows), default=1)
+        self.owners = np.array([row[0] for row in rows], dtype=np.intp)
+        self.weights = np.zeros((len(rows), width))
+        self.sources = np.full((len(rows), width), padding_source, dtype=np.intp)
+        for index, (_, _, weights, sources, _) in enumerate(rows):
+            self.weights[index, :len(weights)] = weights
+            self.sources[index, :len(sources)] = sources
+        self.counts = np.array([len(row[2]) for row in rows], dtype=np.float64)
+        self.biases = np.array([row[4] for row in rows], dtype=np.float64)
+        self.neurons, self.outputs = np.unique(np.array([row[1] for row in rows], dtype=np.intp), return_inverse=True)
+
+    def calculate(self, values: np.ndarray) -> np.ndarray:
+        # The inputs are added one column at a time, in the same order as a connection on its own adds them
+        total = np.zeros(len(self.biases))
+        for column in range(self.weights.shape[1]):
+            total += self.weights[:, column] * values[self.sources[:, column]]
+        return np.tanh(total / self.counts + self.biases)
+
+
+class PopulationBrains:
+    creatures: list["Creature"]
+    sensor_count: int  # The values start with one value per sensor read, followed by the hidden neurons
+    values: np.ndarray
+    hidden_layers: list[Layer]
+    action_layer: Layer
+    action_types: list[int]
+    sensor_owners: np.ndarray
+    sensor_slots: dict[int, np.ndarray]  # Sensor type -> positions in the values
+    random_reads: int
+    random_slots: np.ndarray
+    random_positions: np.ndarray  # Which of the random numbers drawn this tick belongs to each random slot
+    stateful: list[int]  # Creatures that keep their hidden neurons between ticks
+
+    def __init__(self, creatures: list["Creature"]):
+        self.creatures = creatures
+        sensor_owners: list[int] = []
+        sensor_types: list[int] = []
+        random_positions: list[int] = []
+        self.random_reads = 0
+        hidden_rows: list[list[tuple[int, int, list[float], list[int], float]]] = []
+        action_rows: list[tuple[int, int, list[float], list[int], float]] = []
+        sensory_count = len(brain.SensoryNeuronTypes)
+        action_count = len(brain.ActionNeuronTypes)
+        self.stateful = []
+
+        # Hidden neurons are stored as -1 - (creature * HiddenNeuronCount + neuron) until the amount of sensors is known
+        for owner, creature in enumerate(creatures):
+            creature_brain = creature.brain
+            plan = creature_brain.plan
+            # Stationary brains only draw their random numbers, see Brain.think
+            stationary = creature_brain.kind == brain.BrainKind.Stationary
+            if creature_brain.hidden_state is not None and not stationary:
+                self.stateful.append(owner)
+            start = 0
+            layer_ends = plan.layer_ends + (len(plan.order),)
+            for layer, end in enumerate(layer_ends):
+                for index in plan.order[start:end]:
+                    connection = creature_brain.connections[index]
+                    live = plan.live[index] and not stationary
+                    sources: list[int] = []
+                    for input_index in connection.inputs:
+                        if input_index >= sensory_count:
+                            sources.append(-1 - (owner * HiddenNeuronCount + input_index - sensory_count))
+                            continue
+                        sensor_type = brain.SensoryNeuronTypes[input_index]
+                        if sensor_type == SensoryNeuronType.Rnd.value:
+                            self.random_reads += 1
+                            if live:
+                                random_positions.append(self.random_reads - 1)
+                        if live:
+                            sources.append(len(sensor_owners))
+                            sensor_owners.append(owner)
+                            sensor_types.append(sensor_type)
+                    if not live:
+                        continue
+                    row = (owner, connection.output, list(connection.weights), sources, connection.bias)
+                    if layer < len(plan.layer_ends):
+                        while len(hidden_rows) <= layer:
+                            hidden_rows.append([])
+                        hidden_rows[layer].append(
+                            (owner, owner * HiddenNeuronCount + connection.output - action_count, *row[2:]))
+                    else:
+                        action_rows.append(row)
+                start = end
+
+        self.sensor_count = len(sensor_owners)
+        padding_source = self.sensor_count + len(creatures) * HiddenNeuronCount
+        # One extra value that is always 0, the padding of the layers reads it
+        self.values = np.zeros(padding_source + 1)
+
+        def resolve(rows):
+            return [(owner, output, weights,
+                     [source if source >= 0 else self.sensor_count - 1 - source for source in sources], bias)
+                    for owner, output, weights, sources, bias in rows]
+
+        self.hidden_layers = [Layer(resolve(rows), padding_source) for rows in hidden_rows if rows]
+        self.action_layer = Layer(resolve(action_rows), padding_source)
+        self.action_types = [brain.ActionNeuronTypes[row[1]] for row in action_rows]
+        self.sensor_owners = np.array(sensor_owners, dtype=np.intp)
+        types = np.array(sensor_types, dtype=np.intp)
+        self.sensor_slots = {sensor_type: np.flatnonzero(types == sensor_type)
+                             for sensor_type in brain.SensoryNeuronTypes if np.any(types == sensor_type)}
+        self.random_slots = self.sensor_slots.get(SensoryNeuronType.Rnd.value, np.array([], dtype=np.intp))
+        self.random_positions = np.array(random_positions, dtype=np.intp)
+
+    def think(self, board: "Board", occupied: np.ndarray):
+        # Does the same as calling Brain.think(board, True) for every creature in order.
+        # occupied is True for every tile that has a creature on it, indexed by [x, y]
+        creatures = self.creatures
+        values = self.values
+        self.read_sensors(board, occupied)
+
+        for owner in self.stateful:
+            start = self.sensor_count + owner * HiddenNeuronCount
+            values[start:start + HiddenNeuronCount] = creatures[owner].brain.hidden_state
+        for layer in self.hidden_layers:
+            results = layer.calculate(values)
+            totals = np.zeros(len(layer.neurons))
+            np.add.at(totals, layer.outputs, results)
+            values[self.sensor_count + layer.neurons] = np.tanh(totals)
+        for owner in self.stateful:
+            start = self.sensor_count + owner * HiddenNeuronCount
+            np.frombuffer(creatures[owner].brain.hidden_state)[:] = values[start:start + HiddenNeuronCount]
+
+        for creature in creatures:
+            creature.queued_move = None
+        certainties = self.action_layer.calculate(values).tolist()
+        for owner, action_type, certainty in zip(self.action_layer.owners.tolist(), self.action_types, certainties):
+            creatures[owner].brain.perform_action(action_type, certainty)
+
+    def read_sensors(self, board: "Board", occupied: np.ndarray):
+        creatures = self.creatures
+        values = self.values
+        owners = self.sensor_owners
+        xs = np.array([creature.x for creature in creatures], dtype=np.intp)
+        ys = np.array([creature.y for creature in creatures], dtype=np.intp)
+        rotations = np.array([creature.rotation for creature in creatures], dtype=np.intp)
+
+        # The random numbers are drawn in the same order the creatures would read them one by one,
+        # including the reads of connections that aren't live
+        draws = np.array([brain.random.random() for _ in range(self.random_reads)])
+        values[self.random_slots] = draws[self.random_positions]
+
+        for sensor_type, slots in self.sensor_slots.items():
+            slot_owners = owners[slots]
+            if sensor_type in PositionalSensorTypes:
+                values[slots] = board.sensor_tables.lookup(sensor_type, xs[slot_owners], ys[slot_owners],
+                                                           rotations[slot_owners])
+            elif sensor_type == SensoryNeuronType.LMy.value:
+                values[slots] = LastMovementY[rotations[slot_owners]]
+            elif sensor_type == SensoryNeuronType.LMx.value:
+                values[slots] = LastMovementX[rotations[slot_owners]]
+            elif sensor_type == SensoryNeuronType.Age.value:
+                ages = np.array([creature.age for creature in creatures], dtype=np.float64)
+                values[slots] = clamp_sensor(ages / board.get_steps_per_generation())[slot_owners]
+            elif sensor_type == SensoryNeuronType.Osc.value:
+                # Only once per creature, math.cos doesn't always give the same last bit as np.cos
+                readers, slot_readers = np.unique(slot_owners, return_inverse=True)
+                values[slots] = np.array([creatures[owner].get_osc() for owner in readers.tolist()])[slot_readers]
+            elif sensor_type == SensoryNeuronType.Pop.value:
+                values[slots] = get_population_density(occupied, xs, ys)[slot_owners]
+            elif sensor_type == SensoryNeuronType.Cfd.value:
+                readers, slot_readers = np.unique(slot_owners, return_inverse=True)
+                values[slots] = get_distance_creature_forward(board, occupied, xs, ys, rotations, readers)[slot_readers]
@@ -0,0 +1,138 @@
+# Searches for good simulator settings without the gui.
+# Every configuration runs headless in a process pool and is scored by how many of its creatures end up in the half
+# of the board that survives. Successive halving runs all configurations for a few generations, keeps the best
+# 1/eta of them and lets those run on until they reached eta times as many generations, until one is left or the
+# budget is used up. A configuration that goes on to the next rung continues where it stopped: the worker returns
+# the board and the random state, so it evolves exactly the same as when it had run all generations at once.
+# usage: python sweep.py [amount of random configurations]
+import itertools
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from random import Random
+from typing import Union
+
+from board import Board, seed_random, get_random_state, set_random_state
+
+
+class SweepConfig:
+    board_size: tuple[int, int]
+    population_percentage: int
+    mutation_factor: float
+    steps_per_generation: int
+
+    def __init__(self, board_size: tuple[int, int], population_percentage: int, mutation_factor: float,
+                 steps_per_generation: int):
+        self.board_size = board_size
+        self.population_percentage = population_percentage
+        self.mutation_factor = mutation_factor
+        self.steps_per_generation = steps_per_generation
+
+    def get_creature_count(self) -> int:
+        # Same as the gui
+        return round(self.board_size[0] * self.board_size[1] * (self.population_percentage / 100))
+
+    def __str__(self):
+        return f"{self.board_size[0]}x{self.board_size[1]}, {self.population_percentage:>3}%, " \
+               f"mutation {self.mutation_factor:>5}, {self.steps_per_generation:>4} steps"
+
+
+class SweepResult:
+    config: SweepConfig
+    generations: int
+    score: float
+
+    def __init__(self, config: SweepConfig, generations: int, score: float):
+        self.config = config
+        self.generations = generations
+        self.score = score
+
+
+def grid_configs(board_sizes: list[tuple[int, int]], population_percentages: list[int],
+                 mutation_factors: list[float], steps_per_generation: list[int]) -> list[SweepConfig]:
+    return [SweepConfig(*values) for values in
+            itertools.product(board_sizes, population_percentages, mutation_factors, steps_per_generation)]
+
+
+def random_configs(count: int, board_sizes: list[tuple[int, int]], population_percentages: list[int],
+                   mutation_factors: list[float], steps_per_generation: list[int], seed: int = 1) -> list[SweepConfig]:
+    grid = grid_configs(board_sizes, population_percentages, mutation_factors, steps_per_generation)
+    return Random(seed).sample(grid, min(count, len(grid)))
+
+
+class SweepRun:
+    # Everything needed to let a configuration run on in another worker
+    board: Board
+    random_state: tuple
+    survival_rates: list[float]  # One per generation that ran
+
+    def __init__(self, board: Board, random_state: tuple, survival_rates: list[float]):
+        self.board = board
+        self.random_state = random_state
+        self.survival_rates = survival_rates
+
+    def get_score(self) -> float:
+        # The average survival rate of the last quarter of the generations, the first ones are mostly luck
+        last = self.survival_rates[-max(1, len(self.survival_rates) // 4):]
+        return sum(last) / len(last)
+
+
+def run_config(config: SweepConfig, generations: int, seed: int, run: Union[SweepRun, None] = None) -> SweepRun:
+    # Runs a configuration until it reached the given amount of generations, starting from a run of an earlier rung
+    if run is None:
+        seed_random(seed)
+        # The sweep doesn't look at the lineage, one round of births is all the store has to hold
+        board = Board(config.board_size, config.steps_per_generation, config.get_creature_count(),
+                      config.mutation_factor, False, log_capacity=max(1, config.get_creature_count()))
+        run = SweepRun(board, get_random_state(), [])
+    set_random_state(run.random_state)
+    while len(run.survival_rates) < generations:
+        run.board.run_generation()
+        run.survival_rates.append(run.board.survival_rate)
+    run.random_state = get_random_state()
+    return run
+
+
+def successive_halving(configs: list[SweepConfig], min_generations: int = 2, max_generations: int = 50,
+                       eta: int = 3, seed: int = 1, workers: int = None) -> list[SweepResult]:
+    # Returns the best result of every configuration, sorted from best to worst.
+    # Configurations that were dropped earlier are ranked below the ones that got more generations.
+    results: dict[int, SweepResult] = {}
+    runs: dict[int, SweepRun] = {}
+    remaining = list(range(len(configs)))
+    generations = min_generations
+    with ProcessPoolExecutor(workers) as pool:
+        while remaining:
+            finished_runs = list(pool.map(run_config, [configs[index] for index in remaining],
+                                          [generations] * len(remaining), [seed] * len(remaining),
+                                          [runs.get(index) for index in remaining]))
+            runs = dict(zip(remaining, finished_runs))
+            for index, run in runs.items():
+                results[index] = SweepResult(configs[index], generations, run.get_score())
+            best = max(results[index].score for index in remaining)
+            print(f"{len(remaining):>4} configurations ran for {generations} generations, best {best:0.3f}")
+
+            if len(remaining) == 1 or generations >= max_generations:
+                break
+            remaining.sort(key=lambda config_index: results[config_index].score, reverse=True)
+            remaining = remaining[:max(1, len(remaining) // eta)]
+            generations = min(generations * eta, max_generations)
+
+    return sorted(results.values(), key=lambda result: (result.generations, result.score), reverse=True)
+
+
+def print_results(results: list[SweepResult]):
+    print(f"{'rank':>4}  {'configuration':<48} {'generations':>11} {'score':>6}")
+    for rank, result in enumerate(results, 1):
+        print(f"{rank:>4}  {str(result.config):<48} {result.generations:>11} {result.score:>6.3f}")
+
+
+if __name__ == '__main__':
+    sizes = [(20, 20), (30, 30), (50, 50)]
+    percentages = [5, 10, 20, 40]
+    factors = [1, 5, 10, 20, 40]
+    steps = [15, 30, 60]
+    if len(sys.argv) > 1:
+        sweep_configs = random_configs(int(sys.argv[1]), sizes, percentages, factors, steps)
+    else:
+        sweep_configs = grid_configs(sizes, percentages, factors, steps)
+    print_results(successive_halving(sweep_configs))